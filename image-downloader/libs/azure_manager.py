@@ -1,10 +1,14 @@
 import os
-import re
 import csv
+import pathlib
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from azure.storage.blob import BlobServiceClient
 from azure.storage.blob import ContentSettings
 
+_ROOT = pathlib.Path.cwd()
+
 
 class AzureManager():
     '''
@@ -18,20 +22,25 @@ class AzureManager():
         The target container to send the images
     connection_string : str
         The connection string to authorize access to Azure APIs
+    max_workers : int
+        Number of threads used to upload the files
 
     Methods
     -------
     send_files(directory, content_type)
         Send the files to the Azure container from a given directory, setting it's content type
+    _upload_file(path, name, length, content_settings)
+        Upload a single file to the Azure container
     _generate_csv_from_files(directory_files)
         Read the files from the origin directory and creates the new links
     '''
-    def __init__(self, account: str, container: str, connection_string: str):
+    def __init__(self, account: str, container: str, connection_string: str, max_workers: int = 16):
         self.blob_service_client = BlobServiceClient.from_connection_string(connection_string)
         self.container_client = self.blob_service_client.get_container_client(container)
         self.url_base = f'https://{account}.blob.core.windows.net/{container}/'
-        self.root_folder = os.getcwd().replace('\\', '/')
-        self.report_path = f'{self.root_folder}/report'
+        self.root_folder = _ROOT
+        self.report_path = _ROOT / 'report'
+        self.max_workers = max_workers
         if not self.container_client.exists():
             print(f'Container {container} not found!')
             return False
@@ -47,17 +56,38 @@ class AzureManager():
         content_type : str
             The content type for the files that will be sent to the container
         '''
-        folder = f'{self.root_folder}/{directory}'
-        files_to_upload = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f))]
-        self._generate_csv_from_files(files_to_upload)
+        folder = self.root_folder / directory
+        with os.scandir(folder) as it:
+            files_to_upload = [entry for entry in it if entry.is_file()]
+        self._generate_csv_from_files([entry.name for entry in files_to_upload])
         content_settings = ContentSettings(content_type=content_type)
-        count = 0
-        for file in files_to_upload:
-            with open(f'{folder}/{file}', "rb") as f:
-                self.container_client.upload_blob(name=f'{file}', data=f,
-                                                  overwrite=True, content_settings=content_settings)
-                print(f'Image [ {file} ] upload completed. - {count}/{len(files_to_upload)}')
-                count += 1
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._upload_file, entry.path, entry.name, entry.stat().st_size,
+                                       content_settings): entry.name
+                       for entry in files_to_upload}
+            for count, future in enumerate(as_completed(futures), start=1):
+                future.result()
+                print(f'Image [ {futures[future]} ] upload completed. - {count}/{len(files_to_upload)}')
+
+    def _upload_file(self, path: str, name: str, length: int, content_settings: ContentSettings):
+        '''
+        Upload a single file to the set Azure container
+
+        Parameters
+        ----------
+        path : str
+            The path of the file to be sent
+        name : str
+            The blob name to be used in the container
+        length : int
+            The size of the file in bytes
+        content_settings : ContentSettings
+            The content settings for the blob
+        '''
+        with open(path, "rb") as f:
+            self.container_client.upload_blob(name=name, data=f, length=length,
+                                              overwrite=True, content_settings=content_settings,
+                                              max_concurrency=4)
 
     def _generate_csv_from_files(self, directory_files: list):
         '''
@@ -68,33 +98,14 @@ class AzureManager():
         directory_files : list
             A list with all the files contained in a directory
         '''
-        dict_files = {}
-        for file in directory_files:
-            file_name = file
-            end_string = '[/_][0-9].jpg'
-            ends_with = re.search(end_string, file_name)
-            if ends_with is not None:
-                sufix = file_name.split('_')[-1]
-                base_name = file_name.replace(f'_{sufix}', '')
-                try:
-                    know_files = dict_files[base_name]
-                    know_files.append(file_name)
-                    dict_files[base_name] = know_files
-                except KeyError:
-                    dict_files[base_name] = [file_name]
+        dict_files = defaultdict(list)
+        for file_name in directory_files:
+            if file_name.endswith('.jpg') and len(file_name) >= 6 and file_name[-5].isdigit() and file_name[-6] == '_':
+                base_name = file_name.rsplit('_', 1)[0]
             else:
                 base_name = file_name.split('.')[0]
-                try:
-                    know_files = dict_files[base_name]
-                    know_files.append(file_name)
-                    dict_files[base_name] = know_files
-                except KeyError:
-                    dict_files[base_name] = [file_name]
-        for file_name in dict_files:
-            file_list = dict_files[file_name]
-            urls = [file_name]
-            for name in file_list:
-                urls.append(f'{self.url_base}{name}')
-            with open(f'{self.report_path}/new_file.csv', 'a', encoding='utf-8', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow(urls)
+            dict_files[base_name].append(file_name)
+        with open(self.report_path / 'new_file.csv', 'a', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerows([file_name, *[f'{self.url_base}{name}' for name in file_list]]
+                             for file_name, file_list in dict_files.items())
@@ -1,15 +1,23 @@
 import urllib3
-import socket
-import requests
+import re
 import csv
 import os
+import threading
+import pathlib
 import PIL
 
-from PIL import Image, UnidentifiedImageError
+from PIL import Image, ImageOps, UnidentifiedImageError
 from urllib.error import HTTPError
+from urllib.parse import quote, urlsplit, urlunsplit
 from io import BytesIO
-from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
+_ROOT = pathlib.Path.cwd()
+_LANCZOS = PIL.Image.LANCZOS
+_JPEG_OPTIONS = {'quality': 75, 'optimize': False, 'progressive': False, 'subsampling': 2}
+_URL_SAFE = "/?:@!$&'()*+,;=[]%"
+_BARE_PERCENT_RE = re.compile(r'%(?![0-9A-Fa-f]{2})')
 
 
 class ImageManager():
@@ -24,210 +32,373 @@ class ImageManager():
         Flag to indicate if the images will be resized
     new_size : int
         Max width or height size to the new image
+    max_workers : int
+        Number of threads used to download the images
+    max_processes : int
+        Number of processes used to decode, resize and save the images, defaults to the number of CPUs
+    batch_size : int
+        Number of downloaded images sent to the Process Pool on each job, by default it is derived from the number
+        of images and processes, keeping every process busy
+    max_pending : int
+        Max number of downloaded images held in memory while waiting to be processed
 
     Methods
     -------
+    close()
+        Close the error report file, also called when leaving a with block
     start_download()
-        Start the download process with a Thread Pool 
-    _donwload_images(link_list) -> bool
-        Receives a list with a file name and a link and return if the download was succesfull
+        Start the download process with a Thread Pool and the image processing with a Process Pool
+    _reserve_and_download(slots, stop, img_name, link) -> bytes
+        Waits for a free pending slot and downloads the image, the slot is released if the download fails
+    _donwload_images(img_name, link) -> bytes
+        Receives a file name and a link and return the downloaded content if the download was succesfull
+    _report_batch(names, errors) -> int
+        Prints the saved images of a processed batch, reports the broken ones and returns the number saved
+    _log_error(img_name, reason, link)
+        Writes a failed image to the error report
     _return_links(csv_path) -> list
         Receives a csv file path and return a list of file names and links
-    _remove_transparency(image_object, background_color) -> PIL.Image.Image
-        Receives a PIL object, removes all transparencys and returns the new object
-    _resize_image(image) -> PIL.Image.Image
-        Receives a PIL object, resizes it the the desired size and returns the new object
     '''
-    def __init__(self, image_name_prefix: str = '', resize: bool = False, new_size: int = 1000):
+    def __init__(self, image_name_prefix: str = '', resize: bool = False, new_size: int = 1000, max_workers: int = 32,
+                 max_processes: int = None, batch_size: int = None, max_pending: int = 64):
         self.name_prefix = image_name_prefix
         self.resize = resize
         self.new_size = new_size
-        self.image_path = str(os.getcwd().replace('\\', '/')) + '/images'
-        self.error_path = str(os.getcwd().replace('\\', '/')) + '/report'
-        try:
-            os.mkdir(self.image_path)
-        except FileExistsError:
-            pass
-        try:
-            os.mkdir(self.error_path)
-        except FileExistsError:
-            pass
+        self.max_workers = max_workers
+        self.max_processes = max_processes
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        hdr = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.169 Safari/537.36'}
+        timeout = urllib3.util.Timeout(connect=5, read=10)
+        self.http = urllib3.PoolManager(num_pools=32, maxsize=max_workers, timeout=timeout, headers=hdr)
+        self.image_path = _ROOT / 'images'
+        self.error_path = _ROOT / 'report'
+        self.image_path.mkdir(exist_ok=True)
+        self.error_path.mkdir(exist_ok=True)
+        self._err_f = open(self.error_path / 'error.csv', 'a', newline='', encoding='UTF-8')
+        self._err_w = csv.writer(self._err_f)
+        self._err_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''
+        Close the error report file
+        '''
+        self._err_f.close()
 
     def start_download(self, csv_path: str) -> int:
-        download_links = self._return_links(csv_path=csv_path)
+        new_size = self.new_size if self.resize else None
         total_downloaded = 0
-        with ThreadPoolExecutor() as executor:
-            for url_pair in download_links:
-                future = executor.submit(self._donwload_images, url_pair)
-                result = future.result()
-                if result:
-                    total_downloaded += 1
+        download_links = self._return_links(csv_path=csv_path)
+        processes = self.max_processes or os.cpu_count()
+        batch_size = self.batch_size or max(1, min(8, len(download_links) // (processes * 4)))
+        slots = threading.BoundedSemaphore(max(self.max_pending, batch_size))
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as downloader, \
+                ProcessPoolExecutor(max_workers=processes) as processor:
+            try:
+                downloads = {}
+                for name, link in download_links:
+                    img_name = f'{self.name_prefix}{name}.jpg'
+                    downloads[downloader.submit(self._reserve_and_download, slots, stop, img_name, link)] = \
+                        (img_name, link)
+                downloaded = ((*downloads.pop(future), future.result()) for future in as_completed(downloads))
+                downloaded = (item for item in downloaded if item[2] is not None)
+                jobs = {}
+                while batch := list(islice(downloaded, batch_size)):
+                    job = processor.submit(_decode_resize_save_batch,
+                                           [(data, self.image_path / img_name) for img_name, _, data in batch],
+                                           new_size)
+                    job.add_done_callback(lambda _, count=len(batch): _release(slots, count))
+                    jobs[job] = [(img_name, link) for img_name, link, _ in batch]
+                    for done in [job for job in jobs if job.done()]:
+                        total_downloaded += self._report_batch(jobs.pop(done), done.result())
+                for job in as_completed(jobs):
+                    total_downloaded += self._report_batch(jobs.pop(job), job.result())
+            finally:
+                stop.set()
+                downloader.shutdown(wait=False, cancel_futures=True)
         return total_downloaded
 
-    def _donwload_images(self, link_list: list) -> bool:
+    def _reserve_and_download(self, slots: threading.BoundedSemaphore, stop: threading.Event, img_name: str,
+                              link: str) -> bytes:
         '''
-        Download an image file from a given image name and url pair list
+        Wait for a free pending slot before downloading an image, so only a limited number of downloaded images
+        are held in memory until the Process Pool handles them. The slot is released here if the download fails,
+        otherwise it is released when the image is processed. Gives up without downloading once the stop event is set
 
         Parameters
         ----------
-        link_list : list
-            A list with a image name and url pair
+        slots : threading.BoundedSemaphore
+            The semaphore counting the downloaded images waiting to be processed
+        stop : threading.Event
+            Set when start_download is leaving, so waiting downloads don't block the shutdown
+        img_name : str
+            The file name of the image, used to report errors
+        link : str
+            The url of the image
 
         Returns
         -------
-        bool
-            Returns True if the download is succesfull and False otherwise
+        bytes
+            Returns the image content if the download is succesfull and None otherwise
         '''
-        hdr = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.169 Safari/537.36'}
-        img_name = f'{self.name_prefix}{link_list[0]}.jpg'
-        link = link_list[1]
+        while not slots.acquire(timeout=1):
+            if stop.is_set():
+                return None
+        data = None
         try:
-            timeout = urllib3.util.Timeout(connect=5, read=10)
-            http = urllib3.PoolManager(timeout=timeout)
-            response = http.request('GET', link, headers=hdr)
-            if response.status != 200:
-                raise HTTPError(link, response.status,  response.reason, response.headers, None)
-            file = Image.open(BytesIO(response.data))
-            file = self._remove_transparency(file)
-            file = file.convert('RGB')
-            if self.resize:
-                new_image = self._resize_image(file)
-                new_image.save(f'{self.image_path}/{img_name}')
-                print(f"\tImage {img_name} resized")
-                return True
-            else:
-                file.save(f'{self.image_path}/{img_name}')
-                print(f"\tImage {img_name} resized")
-                return True
-        except UnicodeEncodeError:
-            response = requests.get(link, timeout=10)
-            file = Image.open(BytesIO(response.content))
-            file = self._remove_transparency(file)
-            file = file.convert('RGB')
-            if self.resize:
-                new_image = self._resize_image(file)
-                new_image.save(f'{self.image_path}/{img_name}')
-                print(f"\tImage {img_name} resized")
-                return True
-            else:
-                file.save(f'{self.image_path}/{img_name}')
-                print(f"\tImage {img_name} resized")
-                return True
-        except UnidentifiedImageError:
-            with open(f'{self.error_path}/error.csv', 'a', newline='', encoding='UTF-8') as f:
-                writer = csv.writer(f)
-                writer.writerow([img_name, 'Image Broken', link])
-            print('Error downloading image: Image Broken')
-            return False
-        except HTTPError as err:
-            with open(f'{self.error_path}/error.csv', 'a', newline='', encoding='UTF-8') as f:
-                writer = csv.writer(f)
-                writer.writerow([img_name, str(err), link])
-            print(f'Error downloading image: {err}')
-            return False
-        except socket.timeout:
-            with open(f'{self.error_path}/error.csv', 'a', newline='', encoding='UTF-8') as f:
-                writer = csv.writer(f)
-                writer.writerow([img_name, 'Timeout Err', link])
-            print('Error downloading image: Connection Timeout')
-            return True
+            if not stop.is_set():
+                data = self._donwload_images(img_name, link)
+            return data
+        finally:
+            if data is None:
+                slots.release()
 
-    def _return_links(self, csv_path: str) -> list:
+    def _donwload_images(self, img_name: str, link: str) -> bytes:
         '''
-        Read a csv file from the the given path and return a list of lists
+        Download the content of an image file from a given image name and url
 
         Parameters
         ----------
-        csv_path : str
-            A string containing the path to the base csv file
+        img_name : str
+            The file name of the image, used to report errors
+        link : str
+            The url of the image
 
         Returns
         -------
-        list
-            Returns a list of sublists, containing a image name and url pair
+        bytes
+            Returns the image content if the download is succesfull and None otherwise
         '''
-        with open(csv_path, 'r') as f:
-            url_list = list(csv.reader(f))
-        link_list = []
-        for row in url_list:
-            img_links = []
-            img_row_name = row[0]
-            for columns in row:
-                if 'http' in columns:
-                    img_links.append(columns)
-                else:
-                    continue
-            count = 0
-            img_name = ''
-            num = ''
-            for link in img_links:
-                if count > 0:
-                    num = '_' + str(count)
-                img_name = img_row_name + num
-                link_list.append([img_name, link])
-                count += 1
-        return link_list
+        try:
+            response = self.http.request('GET', _encode_link(link))
+            if response.status != 200:
+                raise HTTPError(link, response.status,  response.reason, response.headers, None)
+            return response.data
+        except (UnicodeError, ValueError):
+            self._log_error(img_name, 'Invalid Link', link)
+            return None
+        except HTTPError as err:
+            self._log_error(img_name, str(err), link)
+            return None
+        except urllib3.exceptions.HTTPError as err:
+            if isinstance(err, urllib3.exceptions.MaxRetryError):
+                err = err.reason
+            if isinstance(err, urllib3.exceptions.TimeoutError) and \
+                    not isinstance(err, urllib3.exceptions.NewConnectionError):
+                self._log_error(img_name, 'Timeout Err', link)
+            else:
+                self._log_error(img_name, str(err), link)
+            return None
 
-    def _remove_transparency(self, image_object: PIL.Image.Image, background_color=(255, 255, 255)) -> PIL.Image.Image:
+    def _report_batch(self, names: list, errors: list) -> int:
         '''
-        Remove all the transparency layers from a given PIL object
+        Report the result of a processed batch, printing the saved images and writing the broken ones to the error
+        report
 
         Parameters
         ----------
-        image_object : PIL.Image.Image
-            A PIL Image Object to have it's transparencies removed
-        background_color : tuple
-            A tuple containing the RGB value of the background color to be used
+        names : list
+            A list of image name and url pairs, in the batch order
+        errors : list
+            A list with None for each saved image and the error reason for each broken one, in the batch order
 
         Returns
         -------
-        PIL.Image.Image
-            Returns a PIL Image Object with it's transparencies removed
+        int
+            Returns the number of images saved in the batch
         '''
-        if image_object.mode in ('RGBA', 'LA', 'P') or (image_object.mode == 'P' and 'transparency' in image_object.info):
-            alpha = image_object.convert('RGBA').split()[-1]
-            background = Image.new("RGBA", image_object.size, background_color + (255,))
-            background.paste(image_object, mask=alpha)
-            return background
-        else:
-            return image_object
+        saved = 0
+        for (img_name, link), error in zip(names, errors):
+            if error is not None:
+                self._log_error(img_name, error, link)
+                continue
+            print(f"\tImage {img_name} saved")
+            saved += 1
+        return saved
+
+    def _log_error(self, img_name: str, reason: str, link: str):
+        '''
+        Write a failed image to the error report
+
+        Parameters
+        ----------
+        img_name : str
+            The file name of the image
+        reason : str
+            The reason of the failure
+        link : str
+            The url of the image
+        '''
+        with self._err_lock:
+            self._err_w.writerow([img_name, reason, link])
+            self._err_f.flush()
+        print(f'Error downloading image: {reason}')
 
-    def _resize_image(self, image: PIL.Image.Image) -> PIL.Image.Image:
+    def _return_links(self, csv_path: str) -> list:
         '''
-        Receive, resize and returns a PIL Object
+        Read a csv file from the the given path and return a list of lists
 
         Parameters
         ----------
-        image : PIL.Image.Image
-            A PIL Image Object to be resized
+        csv_path : str
+            A string containing the path to the base csv file
 
         Returns
         -------
-        PIL.Image.Image
-            Returns a PIL Image Object with it's new size
+        list
+            Returns a list of sublists, containing a image name and url pair
         '''
-        width, height = image.size
-        if width != height:
-            size = (self.new_size, self.new_size)
-            if width > height:
-                wpercent = (self.new_size/width)
-                hsize = int(height*float(wpercent))
-                image = image.resize((self.new_size, hsize), PIL.Image.LANCZOS)
-                new_image = Image.new('RGB', size, (255, 255, 255))
-                new_image.paste(image, (int((size[0] - image.size[0]) / 2), int((size[1] - image.size[1]) / 2)))
-                return new_image
-            elif height > width:
-                hpercent = (self.new_size/height)
-                wsize = int(width*float(hpercent))
-                image = image.resize((wsize, self.new_size), PIL.Image.LANCZOS)
-                new_image = Image.new('RGB', size, (255, 255, 255))
-                new_image.paste(image, (int((size[0] - image.size[0]) / 2), int((size[1] - image.size[1]) / 2)))
-                return new_image
-            else:
-                image = image.resize(size, PIL.Image.LANCZOS)
-                return image
-        elif width != self.new_size or height != self.new_size:
-            image = image.resize((self.new_size, self.new_size), PIL.Image.LANCZOS)
-            return image
+        link_list = []
+        with open(csv_path, 'r') as f:
+            for row in csv.reader(f):
+                img_links = (column for column in row[1:] if column.startswith('http'))
+                for count, link in enumerate(img_links):
+                    img_name = row[0] if count == 0 else f'{row[0]}_{count}'
+                    link_list.append([img_name, link])
+        return link_list
+
+
+def _encode_link(link: str) -> str:
+    '''
+    Encode a link into an ASCII url, the host is IDNA encoded and the path, query and fragment are percent-encoded.
+    Existing %XX escapes are kept, while bare % signs are escaped
+
+    Parameters
+    ----------
+    link : str
+        The url of the image as found in the csv file
+
+    Returns
+    -------
+    str
+        Returns the encoded url
+    '''
+    scheme, netloc, path, query, fragment = urlsplit(link)
+    if not netloc.isascii():
+        userinfo, at, hostport = netloc.rpartition('@')
+        host, colon, port = hostport.partition(':')
+        netloc = f"{userinfo}{at}{host.encode('idna').decode('ascii')}{colon}{port}"
+    path, query, fragment = (quote(_BARE_PERCENT_RE.sub('%25', part), safe=_URL_SAFE)
+                             for part in (path, query, fragment))
+    return urlunsplit((scheme, netloc, path, query, fragment))
+
+
+def _release(slots: threading.BoundedSemaphore, count: int):
+    '''
+    Release a number of pending slots once their images were processed
+
+    Parameters
+    ----------
+    slots : threading.BoundedSemaphore
+        The semaphore counting the downloaded images waiting to be processed
+    count : int
+        The number of slots to release
+    '''
+    for _ in range(count):
+        slots.release()
+
+
+def _decode_resize_save_batch(batch: list, new_size: int = None) -> list:
+    '''
+    Decode, resize and save a batch of downloaded images inside a single Process Pool job
+
+    Parameters
+    ----------
+    batch : list
+        A list of image content and destination path pairs
+    new_size : int
+        Max width or height size to the new images, the images are not resized if None
+
+    Returns
+    -------
+    list
+        Returns a list with None for each saved image and the error reason for each broken one, in the batch order
+    '''
+    errors = []
+    for data, path in batch:
+        try:
+            _decode_resize_save(data, path, new_size)
+        except UnidentifiedImageError:
+            errors.append('Image Broken')
+        except Exception as err:
+            errors.append(f'Image Broken: {err}')
         else:
-            return image
+            errors.append(None)
+    return errors
+
+
+def _decode_resize_save(data: bytes, path: pathlib.Path, new_size: int = None):
+    '''
+    Decode a downloaded image, remove it's transparencies, resize it if requested and save it as a jpeg file.
+    Runs inside the Process Pool, so it must stay a module level function
+
+    Parameters
+    ----------
+    data : bytes
+        The downloaded image content
+    path : pathlib.Path
+        The path where the jpeg file will be saved
+    new_size : int
+        Max width or height size to the new image, the image is not resized if None
+    '''
+    file = Image.open(BytesIO(data))
+    if new_size:
+        file.draft(None, (new_size * 2, new_size * 2))
+    file = _remove_transparency(file)
+    if file.mode != 'RGB':
+        file = file.convert('RGB')
+    if new_size and file.size != (new_size, new_size):
+        file = _resize_image(file, new_size)
+    file.save(path, **_JPEG_OPTIONS)
+
+
+def _remove_transparency(image_object: PIL.Image.Image, background_color=(255, 255, 255)) -> PIL.Image.Image:
+    '''
+    Remove all the transparency layers from a given PIL object
+
+    Parameters
+    ----------
+    image_object : PIL.Image.Image
+        A PIL Image Object to have it's transparencies removed
+    background_color : tuple
+        A tuple containing the RGB value of the background color to be used
+
+    Returns
+    -------
+    PIL.Image.Image
+        Returns a PIL Image Object with it's transparencies removed
+    '''
+    if image_object.mode in ('RGBA', 'LA') or (image_object.mode == 'P' and 'transparency' in image_object.info):
+        background = Image.new("RGBA", image_object.size, background_color + (255,))
+        return Image.alpha_composite(background, image_object.convert('RGBA'))
+    else:
+        return image_object
+
+
+def _resize_image(image: PIL.Image.Image, new_size: int) -> PIL.Image.Image:
+    '''
+    Receive, resize and returns a PIL Object
+
+    Parameters
+    ----------
+    image : PIL.Image.Image
+        A PIL Image Object to be resized
+    new_size : int
+        Max width or height size to the new image
+
+    Returns
+    -------
+    PIL.Image.Image
+        Returns a PIL Image Object with it's new size
+    '''
+    factor = int(max(image.size) / new_size / 3)
+    if factor > 1:
+        image = image.reduce(factor)
+    return ImageOps.pad(image, (new_size, new_size), method=_LANCZOS, color=(255, 255, 255))
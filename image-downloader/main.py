@@ -12,8 +12,8 @@ def main():
     azure_container = input('Insert your azure container name: ')
     connection_string = '' #Insert your Connection String
 
-    img_manager = ImageManager(image_prefix, True)
-    downloaded = img_manager.start_download(csv_path=csv_file_name)
+    with ImageManager(image_prefix, True) as img_manager:
+        downloaded = img_manager.start_download(csv_path=csv_file_name)
     print(f'{downloaded} - Files Downloaded')
     azure_manager = AzureManager(
         account=azure_account,